@@ -1,21 +1,28 @@
+import base64
+import functools
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Any, Union
+from typing import Any, Optional, Union
 
 import cairosvg
 import matplotlib.pyplot as plt
+import numpy as np
 import skunk
+from PIL import Image
 
 
-def _label_axes(
+def _add_label_texts(
     axs,
     fontsize: int = 30,
     label_pos: tuple[float, float] = (0.0, 1.0),
     horizontalalignment: str = "left",
     verticalalignment: str = "top",
-) -> None:
+) -> list:
+    texts = []
     for label, ax in axs.items():
-        ax.autoscale(False)
-        ax.text(
+        text = ax.text(
             *label_pos,
             label + "",
             horizontalalignment=horizontalalignment,
@@ -24,7 +31,92 @@ def _label_axes(
             fontsize=fontsize,
             clip_on=False,
         )
-        ax.set(xticks=[], yticks=[])
+        texts.append(text)
+    return texts
+
+
+def _label_axes(
+    axs,
+    fontsize: int = 30,
+    label_pos: tuple[float, float] = (0.0, 1.0),
+    horizontalalignment: str = "left",
+    verticalalignment: str = "top",
+) -> list:
+    texts = _add_label_texts(
+        axs,
+        fontsize=fontsize,
+        label_pos=label_pos,
+        horizontalalignment=horizontalalignment,
+        verticalalignment=verticalalignment,
+    )
+    for ax in axs.values():
+        ax.autoscale(False)
+        # clearing ticks resets the tick locators/formatters, which is wasted work if
+        # the axis is already hidden
+        if ax.axison:
+            ax.set(xticks=[], yticks=[])
+    return texts
+
+
+def _file_key(path: Union[str, Path]) -> tuple[str, int, int]:
+    # identify a file by its absolute path, so that relative paths are not confused
+    # across working directories, and by its modification time and size, so that an
+    # edit within the filesystem's mtime granularity is still noticed
+    stat = os.stat(path)
+    return os.path.abspath(path), stat.st_mtime_ns, stat.st_size
+
+
+# decoded panels are cached by file, so that a panel used in several figures is only
+# read from disk once; full resolution panels can be large, so only a few are kept
+@functools.lru_cache(maxsize=16)
+def _read_png(
+    path: str, mtime_ns: int, size: int, max_size: Optional[tuple[int, int]]
+) -> np.ndarray:
+    # the extension is known to be .png, so skip sniffing for other formats
+    with Image.open(path, formats=("PNG",)) as img:
+        if img.mode in ("I", "I;16", "I;16B", "I;16L"):
+            # 16-bit grayscale; scale down to 8 bits, as convert() would clip instead
+            img = Image.fromarray((np.asarray(img) >> 8).astype(np.uint8))
+        if img.mode not in ("RGB", "RGBA"):
+            img = img.convert("RGBA")
+        if max_size is not None:
+            # only ever shrinks the image, preserving its aspect ratio
+            img.thumbnail(max_size, Image.LANCZOS)
+        arr = np.asarray(img, dtype=np.uint8)
+    # the same array may be shared between figures
+    arr.setflags(write=False)
+    return arr
+
+
+def _load_png(
+    path: Union[str, Path], max_size: Optional[tuple[int, int]] = None
+) -> np.ndarray:
+    return _read_png(*_file_key(path), max_size)
+
+
+@functools.lru_cache(maxsize=64)
+def _read_svg(path: str, mtime_ns: int, size: int) -> str:
+    with open(path) as f:
+        return f.read()
+
+
+def _load_svg(path: Union[str, Path]) -> str:
+    return _read_svg(*_file_key(path))
+
+
+# geometry attributes written by matplotlib's SVG backend; transforms are excluded
+# since they can hold small scale factors that would not survive truncation
+_SVG_GEOMETRY_ATTR = re.compile(r'\b(d|x|y|width|height)="([^"]*)"')
+
+
+def _truncate_svg_precision(svg: str, precision: int) -> str:
+    fraction = re.compile(rf"(\d\.\d{{{precision}}})\d+")
+
+    def truncate(match: re.Match) -> str:
+        value = fraction.sub(r"\1", match[2])
+        return f'{match[1]}="{value}"'
+
+    return _SVG_GEOMETRY_ATTR.sub(truncate, svg)
 
 
 class PanelMosaic:
@@ -34,23 +126,86 @@ class PanelMosaic:
         figsize=(10, 8),
         layout="tight",
         gridspec_kw=None,
+        svg_precision: Optional[int] = 2,
     ):
         self.mosaic = mosaic
         self.figsize = figsize
         self.layout = layout
+        # number of decimal places kept in SVG coordinates, or None to keep them all
+        self.svg_precision = svg_precision
 
         if gridspec_kw is None:
             self.gridspec_kw = dict(hspace=0.0, wspace=0.0)
 
         self.fig, self.axs = self._set_up_axes()
 
-        self.panel_mapping = None
+        self._label_texts = []
 
-        self.svg = skunk.pltsvg(self.fig)
+        self.panel_mapping = None
+        self.png_panel_mapping = {}
+        self.svg_panel_mapping = {}
+
+        # the rendered SVG is computed lazily and invalidated whenever the figure is
+        # modified, so that the (slow) SVG backend only runs when it is needed
+        self._svg_cache = None
+        # whether the layout has already been solved for the figure as it is, e.g. to
+        # measure panels in `map`, so that rendering does not need to solve it again
+        self._layout_solved = False
+        # encoded copies of the SVG for writing and notebook display, each stored
+        # alongside the SVG string it was derived from
+        self._svg_bytes_cache = None
+        self._b64_cache = None
+
+    @property
+    def svg(self) -> str:
+        """The figure rendered as an SVG string, with any SVG panels inserted."""
+        if self._svg_cache is None:
+            self._svg_cache = self._render_svg()
+        return self._svg_cache
+
+    def _render_svg(self) -> str:
+        svg = self._pltsvg()
+        if self.svg_precision is not None:
+            svg = _truncate_svg_precision(svg, self.svg_precision)
+        if self.svg_panel_mapping:
+            replacements = {
+                label: _load_svg(path) for label, path in self.svg_panel_mapping.items()
+            }
+            svg = skunk.insert(replacements, svg=svg)
+        return svg
+
+    def _laid_out_panel_sizes(self) -> dict[str, tuple[float, float]]:
+        # the layout engine normally only runs when the figure is drawn, so run it
+        # here to measure the panels at the size they will actually be rendered
+        layout_engine = self.fig.get_layout_engine()
+        if layout_engine is not None and not self._layout_solved:
+            layout_engine.execute(self.fig)
+        self._layout_solved = True
+        inches = self.fig.dpi_scale_trans.inverted()
+        panel_sizes = {}
+        for label, ax in self.axs.items():
+            bbox = ax.get_window_extent().transformed(inches)
+            panel_sizes[label] = (bbox.width, bbox.height)
+        return panel_sizes
+
+    def _pltsvg(self) -> str:
+        if not self._layout_solved:
+            return skunk.pltsvg(self.fig)
+        # the layout is up to date, so detach the layout engine while saving rather
+        # than letting the draw solve it again
+        layout_engine = self.fig.get_layout_engine()
+        self.fig.set_layout_engine(None)
+        try:
+            return skunk.pltsvg(self.fig)
+        finally:
+            self.fig.set_layout_engine(layout_engine)
 
     def _set_up_axes(self):
         # ioff/ion is to avoid displaying the matplotlib figure in notebooks, which
         # will just look like a bunch of blue boxes
+        # the layout engine is only executed when the figure is drawn, or when `map`
+        # measures the panels; `_layout_solved` records the latter so that the layout
+        # is not solved again when the figure is rendered
         plt.ioff()
         fig, axs = plt.subplot_mosaic(
             mosaic=self.mosaic,
@@ -85,13 +240,15 @@ class PanelMosaic:
         verticalalignment :
             The vertical alignment of the panel labels.
         """
-        _label_axes(
+        self._label_texts += _label_axes(
             self.axs,
             fontsize=fontsize,
             label_pos=label_pos,
             horizontalalignment=horizontalalignment,
             verticalalignment=verticalalignment,
         )
+        self._svg_cache = None
+        self._layout_solved = False
 
     def format_axes(self, panel_borders: bool = False) -> None:
         """
@@ -105,8 +262,10 @@ class PanelMosaic:
         for _, ax in self.axs.items():
             if not panel_borders:
                 ax.axis("off")
+        self._svg_cache = None
+        self._layout_solved = False
 
-    def map(self, panel_mapping: dict) -> None:
+    def map(self, panel_mapping: dict, dpi: Optional[float] = None) -> None:
         """
         Map panel images from specified file paths.
 
@@ -114,53 +273,84 @@ class PanelMosaic:
         ----------
         panel_mapping :
             A dictionary mapping panel labels to file paths of panel images.
+        dpi :
+            If specified, PNG panels larger than their panel at this resolution are
+            downsampled to fit it before being embedded. By default, PNG panels are
+            embedded at full resolution.
+
+        Decoded panels are cached for the life of the process, keyed on the file's
+        path, modification time and size, so a panel used in several figures is only
+        read once. The caches can be emptied with
+        `panel_mosaic.panel_mosaic._read_png.cache_clear()` and
+        `panel_mosaic.panel_mosaic._read_svg.cache_clear()`.
         """
         self.panel_mapping = panel_mapping
 
         png_panel_mapping = {}
+        svg_panel_mapping = {}
+        panel_mappings_by_ext = {".png": png_panel_mapping, ".svg": svg_panel_mapping}
         for label, path in panel_mapping.items():
-            if path.endswith(".png"):
-                png_panel_mapping[label] = path
+            ext = os.path.splitext(path)[1].lower()
+            ext_panel_mapping = panel_mappings_by_ext.get(ext)
+            if ext_panel_mapping is not None:
+                ext_panel_mapping[label] = path
         self.png_panel_mapping = png_panel_mapping
+        self.svg_panel_mapping = svg_panel_mapping
 
-        for label, path in png_panel_mapping.items():
-            with open(path, "rb") as f:
-                img = plt.imread(f)
+        if dpi is None:
+            max_sizes = [None] * len(png_panel_mapping)
+        else:
+            panel_sizes = self._laid_out_panel_sizes()
+            max_sizes = [
+                (
+                    max(1, round(panel_sizes[label][0] * dpi)),
+                    max(1, round(panel_sizes[label][1] * dpi)),
+                )
+                for label in png_panel_mapping.keys()
+            ]
+
+        # Pillow releases the GIL while decoding, so panels can be read in parallel
+        with ThreadPoolExecutor() as executor:
+            imgs = executor.map(_load_png, png_panel_mapping.values(), max_sizes)
+            for label, img in zip(png_panel_mapping.keys(), imgs):
                 new_ax = self.axs[label].inset_axes([0.01, 0.01, 0.98, 0.98], zorder=-1)
                 new_ax.imshow(img, interpolation="none", aspect=None)
                 new_ax.axis("off")
 
-        svg_panel_mapping = {}
-        for label, path in panel_mapping.items():
-            if path.endswith(".svg"):
-                svg_panel_mapping[label] = path
-        self.svg_panel_mapping = svg_panel_mapping
-
         for label in svg_panel_mapping.keys():
             skunk.connect(self.axs[label], label)
 
-        self.svg = skunk.insert(svg_panel_mapping)
+        self._svg_cache = None
 
     def __repr__(self) -> str:
         rep = ""
         rep += PanelMosaic.__name__ + "(\n"
-        rep += f"    fig={self.fig.__repr__()},\n"
-        rep += f"    axs={self.axs.__repr__()},\n"
+        rep += f"    figsize={self.figsize!r},\n"
+        rep += f"    labels={list(self.axs.keys())!r},\n"
         rep += f"    panel_mapping={self.panel_mapping.__repr__()},\n"
         rep += ")"
         return rep
 
+    def _svg_bytes(self) -> bytes:
+        svg = self.svg
+        if self._svg_bytes_cache is None or self._svg_bytes_cache[0] is not svg:
+            self._svg_bytes_cache = (svg, svg.encode("utf8"))
+        return self._svg_bytes_cache[1]
+
+    def _svg_b64(self) -> str:
+        svg = self.svg
+        if self._b64_cache is None or self._b64_cache[0] is not svg:
+            data = base64.b64encode(self._svg_bytes()).decode("ascii")
+            self._b64_cache = (svg, data)
+        return self._b64_cache[1]
+
     def _repr_pretty_(self, p, cycle):
         # simply show the plot
         """A convenience function to dispaly SVG string in Jupyter Notebook"""
-        import base64
-
         import IPython.display as display
 
-        data = base64.b64encode(self.svg.encode("utf8"))
-        display.display(
-            display.HTML("<img src=data:image/svg+xml;base64," + data.decode() + ">")
-        )
+        data = self._svg_b64()
+        display.display(display.HTML(f"<img src='data:image/svg+xml;base64,{data}'>"))
 
     def show(self) -> None:
         """
@@ -181,27 +371,68 @@ class PanelMosaic:
         precision :
             The precision of the position displays.
         """
-        dummy_fig, dummy_axs = self._set_up_axes()
-        _label_axes(dummy_axs)
-        for _, ax in dummy_axs.items():
-            bbox = ax.get_window_extent().transformed(
-                dummy_fig.dpi_scale_trans.inverted()
-            )
-            width, height = bbox.width, bbox.height
-            ax.text(
-                0.5,
-                0.5,
-                f"({width:{precision}}, {height:{precision}})",
-                ha="center",
-                va="center",
-                fontsize=fontsize,
-                transform=ax.transAxes,
-                clip_on=False,
-                zorder=100,
+        # draw the dummy annotations onto the existing axes temporarily, rather than
+        # building (and laying out) a second copy of the mosaic; everything changed
+        # here is restored after rendering
+        dummy_texts = []
+        if not self._label_texts:
+            dummy_texts += _add_label_texts(self.axs)
+        axis_states = {}
+        hidden_artists = []
+        for label, ax in self.axs.items():
+            # show the panel borders without ticks, regardless of formatting
+            axis_states[label] = (
+                ax.axison,
+                ax.xaxis.get_visible(),
+                ax.yaxis.get_visible(),
+                ax.patch.get_alpha(),
             )
+            ax.set_axis_on()
+            ax.xaxis.set_visible(False)
+            ax.yaxis.set_visible(False)
             # turn off axis transparency
             ax.patch.set_alpha(0)
-        skunk.display(skunk.pltsvg(dummy_fig))
+            # hide mapped PNG panels and the placeholders for SVG panels
+            for artist in ax.child_axes + [
+                patch for patch in ax.patches if patch.get_gid() == label
+            ]:
+                if artist.get_visible():
+                    artist.set_visible(False)
+                    hidden_artists.append(artist)
+        try:
+            # measure the panels as they will be laid out in the rendered figure, which
+            # has changed since any earlier layout
+            self._layout_solved = False
+            for label, (width, height) in self._laid_out_panel_sizes().items():
+                dummy_texts.append(
+                    self.axs[label].text(
+                        0.5,
+                        0.5,
+                        f"({width:{precision}}, {height:{precision}})",
+                        ha="center",
+                        va="center",
+                        fontsize=fontsize,
+                        transform=self.axs[label].transAxes,
+                        clip_on=False,
+                        zorder=100,
+                    )
+                )
+            dummy_svg = self._pltsvg()
+        finally:
+            # the dummy formatting is undone below, so the layout needs solving again
+            self._layout_solved = False
+            for text in dummy_texts:
+                text.remove()
+            for artist in hidden_artists:
+                artist.set_visible(True)
+            for label, (axison, xvisible, yvisible, alpha) in axis_states.items():
+                ax = self.axs[label]
+                if not axison:
+                    ax.set_axis_off()
+                ax.xaxis.set_visible(xvisible)
+                ax.yaxis.set_visible(yvisible)
+                ax.patch.set_alpha(alpha)
+        skunk.display(dummy_svg)
 
     def write(
         self, out_path: Union[str, Path], formats: tuple = ("svg", "pdf")
@@ -233,8 +464,8 @@ class PanelMosaic:
             The path to write the figure to. The file extension will be appended
             automatically.
         """
-        with open(out_path + ".svg", "w") as f:
-            f.write(self.svg)
+        with open(f"{out_path}.svg", "wb") as f:
+            f.write(self._svg_bytes())
 
     def write_pdf(self, out_path: Union[str, Path]) -> None:
         """
@@ -248,7 +479,7 @@ class PanelMosaic:
             The path to write the figure to. The file extension will be appended
             automatically.
         """
-        cairosvg.svg2pdf(bytestring=self.svg, write_to=str(out_path) + ".pdf")
+        cairosvg.svg2pdf(bytestring=self._svg_bytes(), write_to=f"{out_path}.pdf")
 
 
 def panel_mosaic(
@@ -259,13 +490,19 @@ def panel_mosaic(
     panel_borders: bool = False,
     layout: str = "tight",
     label_pos: tuple = (0, 1),
-) -> str:
+    dpi: Optional[float] = None,
+    svg_precision: Optional[int] = 2,
+) -> PanelMosaic:
+    # a new figure is built on every call rather than cached, since the returned
+    # PanelMosaic can be modified by the caller and every cached figure would stay
+    # open in pyplot
     pm = PanelMosaic(
         mosaic=mosaic,
         figsize=figsize,
         layout=layout,
+        svg_precision=svg_precision,
     )
-    pm.label_axes(fontsize=fontsize, label_pos=label_pos)
     pm.format_axes(panel_borders=panel_borders)
-    pm.map(panel_mapping)
+    pm.label_axes(fontsize=fontsize, label_pos=label_pos)
+    pm.map(panel_mapping, dpi=dpi)
     return pm